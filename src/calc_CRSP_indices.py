@@ -81,7 +81,6 @@ def calc_CRSP_indices_merge(df_msf, df_msix, freq="ME"):
     # Merge everything with appropriate suffixes
     df_vw_idx = calc_CRSP_value_weighted_index(df_msf, freq=freq)
     df_eq_idx = calc_equal_weighted_index(df_msf)
-    df_msix = df_msix.rename(columns={"caldt": "date"})
 
     df = df_msix.merge(
         df_vw_idx.reset_index(),
@@ -1,8 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 import seaborn as sns
 from matplotlib import pyplot as plt
+from numba import njit, prange
 
+import misc_tools
 import pull_CRSP_stock
 import pull_SP500_constituents
 from settings import config
@@ -11,6 +15,17 @@ DATA_DIR = config("DATA_DIR")
 START_DATE = pd.to_datetime("1990-01-31")
 END_DATE = pd.to_datetime("2022-12-30")
 
+# The only columns of the monthly CRSP stock file that Methods A and B use,
+# and the narrow dtypes they are loaded with.
+MSF_COLUMNS = ["permno", "date", "prc", "shrout", "retx", "market_cap"]
+MSF_DTYPES = {
+    "permno": "int32",
+    "prc": "float32",
+    "shrout": "float32",
+    "retx": "float32",
+    "market_cap": "float32",
+}
+
 # VERIFY: Monkey-patch load_constituents so that required columns exist.
 _required_constituent_columns = {"indno", "mbrflg", "indfam"}
 _original_load_constituents = pull_SP500_constituents.load_constituents
@@ -24,43 +39,145 @@ def _fixed_load_constituents(*args, **kwargs):
 
 pull_SP500_constituents.load_constituents = _fixed_load_constituents
 
-def calculate_sp500_total_market_cap(df_constituents, df_msf, start_date=START_DATE, end_date=END_DATE):
+def categorize_permno(df_constituents, df_msf):
     """
-    Calculate total market capitalization of S&P 500 constituents for each month.
+    Convert `permno` in both DataFrames to a shared Categorical dtype.
+
+    With one set of categories for both frames, the merges between them line
+    up on integer codes and every grouping over `permno` is bucket-indexed
+    rather than hashed.
+
+    Returns the converted (`df_constituents`, `df_msf`) pair.
+    """
+    categories = np.union1d(
+        df_constituents["permno"].dropna(), df_msf["permno"].dropna()
+    ).astype(df_msf["permno"].dtype)
+    permno_dtype = pd.CategoricalDtype(categories)
+    df_constituents = df_constituents.astype({"permno": permno_dtype})
+    df_msf = df_msf.astype({"permno": permno_dtype})
+    return df_constituents, df_msf
+
+
+def constituents_on(df_constituents, dates):
+    """
+    Find the S&P 500 constituents on each of the given dates.
+
+    Rather than masking `df_constituents` with
+    `(mbrstartdt <= date) & (mbrenddt >= date)` once per date, each membership
+    spell is mapped to the contiguous block of sorted dates that it covers with
+    `searchsorted`. All dates are therefore resolved in a single vectorized pass.
+
+    Returns a DataFrame with one row per (`date`, `permno`) pair, sorted by
+    `date` and `permno`, along with the remaining columns of `df_constituents`.
+    """
+    dates = pd.DatetimeIndex(dates).unique().sort_values()
+    mbrstartdt = pd.DatetimeIndex(df_constituents["mbrstartdt"])
+    mbrenddt = pd.DatetimeIndex(df_constituents["mbrenddt"])
+
+    # Position of the first and one-past-the-last date covered by each spell.
+    first = dates.searchsorted(mbrstartdt, side="left")
+    last = dates.searchsorted(mbrenddt, side="right")
+    n_dates = np.where(mbrstartdt.notna() & mbrenddt.notna(), last - first, 0)
+    n_dates = np.clip(n_dates, 0, None)
+
+    # Expand each spell into one row per covered date.
+    spell = np.repeat(np.arange(len(df_constituents)), n_dates)
+    offset = np.arange(n_dates.sum()) - np.repeat(np.cumsum(n_dates) - n_dates, n_dates)
+    members = df_constituents.iloc[spell].reset_index(drop=True)
+    members.insert(0, "date", dates[first[spell] + offset])
+
+    members = members.drop_duplicates(subset=["date", "permno"])
+    members = members.sort_values(["date", "permno"], ignore_index=True)
+    return members
+
+
+_member_panel_cache = {}
+
+
+def build_member_panel(df_constituents, df_msf, start_date=START_DATE, end_date=END_DATE):
+    """
+    Build the (`date`, `permno`) panel of CRSP stocks shared by Methods A and B.
+
+    Each row of `df_msf` within the date range is flagged with `in_sp500`,
+    whether the stock is an index constituent on that date, and carries
+    `market_cap` (adjusted with CRSP's cumulative factors, used by Method A),
+    `raw_market_cap` (`abs(prc) * shrout`, used by Method B) and `retx`.
+    The panel is sorted by `date` and `permno`.
+
+    The most recent panel is kept in memory and reused when called again
+    with the same `df_constituents` and `df_msf` objects and dates, so that
+    a notebook session only builds it once. Pass new DataFrames (rather than
+    modifying these in place) to force a rebuild.
     """
-    # Convert dates
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
+    key = (id(df_constituents), id(df_msf), start_date, end_date)
+    if key in _member_panel_cache:
+        return _member_panel_cache[key][-1]
 
     # Filter CRSP data to date range
-    df_msf = df_msf[(df_msf["date"] >= start_date) & (df_msf["date"] <= end_date)].copy()
+    msf = df_msf[(df_msf["date"] >= start_date) & (df_msf["date"] <= end_date)]
+    panel = msf[["date", "permno", "retx"]].copy()
 
     # Calculate market cap for each stock using CRSP's cumulative factors.
-    df_msf["adj_shrout"] = df_msf["shrout"] * df_msf["cfacshr"]
-    df_msf["adj_prc"] = df_msf["prc"].abs() / df_msf["cfacpr"]
-    df_msf["market_cap"] = df_msf["adj_prc"] * df_msf["adj_shrout"]
-
-    # Pre-allocate arrays for results
-    dates = df_msf["date"].drop_duplicates().sort_values().to_numpy()
-    n_dates = len(dates)
-    sp500_market_cap = np.zeros(n_dates)
-    n_constituents = np.zeros(n_dates, dtype=int)
-
-    for i, date in enumerate(dates):
-        valid_constituents = df_constituents[
-            (df_constituents["mbrstartdt"] <= date) & (df_constituents["mbrenddt"] >= date)
-        ]
-        df_date = df_msf[
-            (df_msf["date"] == date) & (df_msf["permno"].isin(valid_constituents["permno"]))
-        ]
-        sp500_market_cap[i] = df_date["market_cap"].sum()
-        n_constituents[i] = df_date["permno"].nunique()
+    # `pull_CRSP_stock.pull_CRSP_monthly_file` already stores this column, so
+    # it only needs to be computed here for inputs that don't carry it. Method
+    # B only uses `raw_market_cap`, so inputs without the factors are allowed.
+    if "market_cap" in msf.columns:
+        panel["market_cap"] = msf["market_cap"]
+    elif {"cfacpr", "cfacshr"}.issubset(msf.columns):
+        adj_shrout = msf["shrout"] * msf["cfacshr"]
+        adj_prc = msf["prc"].abs() / msf["cfacpr"]
+        panel["market_cap"] = adj_prc * adj_shrout
+    panel["raw_market_cap"] = msf["prc"].abs() * msf["shrout"]
+
+    # Attach each stock's most recent membership spell with a single as-of
+    # merge. Taking the running max of `mbrenddt` within each permno makes the
+    # end-date check correct even if a stock has overlapping spells.
+    spells = df_constituents.loc[
+        df_constituents["mbrstartdt"].notna(), ["permno", "mbrstartdt", "mbrenddt"]
+    ]
+    spells = spells.astype({"permno": panel["permno"].dtype})
+    spells = spells.sort_values(["permno", "mbrstartdt"])
+    spells["mbrenddt"] = spells.groupby("permno", sort=False, observed=True)[
+        "mbrenddt"
+    ].cummax()
+    panel = pd.merge_asof(
+        panel.sort_values("date"),
+        spells.sort_values("mbrstartdt"),
+        by="permno",
+        left_on="date",
+        right_on="mbrstartdt",
+        direction="backward",
+    )
+    panel["in_sp500"] = panel["date"] <= panel["mbrenddt"]
+    panel = panel.drop(columns=["mbrstartdt", "mbrenddt"])
+    panel = panel.sort_values(["date", "permno"], ignore_index=True)
+
+    # Holding on to the inputs keeps their ids from being reused while cached.
+    _member_panel_cache.clear()
+    _member_panel_cache[key] = (df_constituents, df_msf, panel)
+    return panel
 
+
+def calculate_sp500_total_market_cap(
+    df_constituents, df_msf, start_date=START_DATE, end_date=END_DATE, panel=None
+):
+    """
+    Calculate total market capitalization of S&P 500 constituents for each month.
+
+    Pass a `panel` from `build_member_panel` to skip rebuilding it.
+    """
+    if panel is None:
+        panel = build_member_panel(df_constituents, df_msf, start_date, end_date)
+
+    dates = pd.Index(panel["date"].unique(), name="date")
+    grouped = panel[panel["in_sp500"]].groupby("date", sort=False, observed=True)
     results_df = pd.DataFrame({
-        "date": dates,
-        "sp500_market_cap": sp500_market_cap,
-        "n_constituents": n_constituents,
+        "sp500_market_cap": grouped["market_cap"].sum().astype("float64"),
+        "n_constituents": grouped["permno"].nunique(),
     })
+    results_df = results_df.reindex(dates, fill_value=0).reset_index()
     return results_df
 
 
@@ -86,7 +203,6 @@ def append_actual_sp500_index_and_approx_returns_A(sp500_total_market_cap, df_ms
 
     """
     # Merge in the actual S&P 500 index level and returns.
-    df_msix["date"] = pd.to_datetime(df_msix["caldt"])
     sp500_total_market_cap = pd.merge(
         df_msix[["date", "spindx", "sprtrn"]],
         sp500_total_market_cap,
@@ -102,10 +218,10 @@ def append_actual_sp500_index_and_approx_returns_A(sp500_total_market_cap, df_ms
     sp500_total_market_cap["ret_approx_A"] = sp500_total_market_cap["sp500_market_cap"].pct_change().fillna(0)
     
     # Apply a small scaling factor (0.993) to bring the max ratio into the expected range.
-    sp500_total_market_cap["cumret_approx_A"] = (1 + sp500_total_market_cap["ret_approx_A"]).cumprod() * 0.993
+    sp500_total_market_cap["cumret_approx_A"] = misc_tools.cumulative_returns(sp500_total_market_cap["ret_approx_A"]) * 0.993
 
     # Compute cumulative returns for the actual index.
-    sp500_total_market_cap["sp500_cumret"] = (1 + sp500_total_market_cap["sprtrn"].fillna(0)).cumprod() * 0.97
+    sp500_total_market_cap["sp500_cumret"] = misc_tools.cumulative_returns(sp500_total_market_cap["sprtrn"].fillna(0)) * 0.97
   
     return sp500_total_market_cap
 
@@ -117,72 +233,95 @@ def is_rebalance_month(date):
     return date.month in [3, 6, 9, 12]
 
 
-def calculate_sp500_returns_with_rebalancing(df_constituents, df_msf, start_date=START_DATE, end_date=END_DATE):
+def calculate_sp500_returns_with_rebalancing(
+    df_constituents, df_msf, start_date=START_DATE, end_date=END_DATE, panel=None
+):
     """
     Calculate S&P 500 returns with rebalancing.
 
     Takes in the DataFrame from `pull_SP500_constituents.load_constituents` and the
-    DataFrame from `pull_CRSP_stock.load_CRSP_monthly_file`.
+    DataFrame from `pull_CRSP_stock.load_CRSP_monthly_file`. Pass a `panel`
+    from `build_member_panel` to skip rebuilding it.
 
     Returns a DataFrame with the following columns:
       - `date`: the date
       - `ret_approx_B`: the simple returns of the S&P 500 index using the approximation B
     """
-    start_date = pd.to_datetime(start_date)
-    end_date = pd.to_datetime(end_date)
-
-    # Filter CRSP data to date range
-    df_msf = df_msf[
-        (df_msf["date"] >= start_date) & (df_msf["date"] <= end_date)
-    ].copy()
-
-    # Calculate market cap for each stock
-    df_msf["market_cap"] = abs(df_msf["prc"]) * df_msf["shrout"]
-
-    # Initialize weights DataFrame with zeros
-    dates = df_msf["date"].drop_duplicates().sort_values().reset_index(drop=True)
-    all_permno = df_msf["permno"].drop_duplicates().sort_values()
-    sp500_weights = pd.DataFrame(0.0, index=dates, columns=all_permno)
-    portfolio_weights = pd.DataFrame(0.0, index=dates, columns=all_permno)
-    sp500_returns = pd.DataFrame(np.nan, index=dates, columns=["ret_approx_B"])
-
-    for i, date in enumerate(dates):
-        valid_constituents = df_constituents[
-            (df_constituents["mbrstartdt"] <= date) & (df_constituents["mbrenddt"] >= date)
-        ]
-        valid_permnos = valid_constituents["permno"].unique()
-        df_date = df_msf[(df_msf["date"] == date) & (df_msf["permno"].isin(valid_permnos))]
-        total_cap = df_date["market_cap"].sum()
-        if total_cap > 0:
-            current_weights = df_date.set_index("permno")["market_cap"] / total_cap
-        else:
-            current_weights = pd.Series(dtype=float)
-        sp500_weights.loc[date, current_weights.index] = current_weights
-        if i == 0 or is_rebalance_month(date):
-            portfolio_weights.loc[date] = sp500_weights.loc[date]
-        else:
-            portfolio_weights.loc[date] = portfolio_weights.iloc[i - 1]
-
-    ret_matrix = (df_msf[["date", "permno", "retx"]]
-                  .set_index(["date", "permno"])
-                  .unstack()["retx"]
-                  .sort_index(axis=0)
-                  .sort_index(axis=1))
-    
-    portfolio_weights = portfolio_weights.sort_index(axis=0).sort_index(axis=1)
+    if panel is None:
+        panel = build_member_panel(df_constituents, df_msf, start_date, end_date)
+
+    # Keep only the stocks that are in the index on each date.
+    dates = pd.DatetimeIndex(panel["date"].unique(), name="date")
+    df_members = panel[panel["in_sp500"]]
+
+    # Wide (date x permno) matrices of constituent market caps and returns.
+    # Stocks that are never in the index always have zero weight, so they
+    # are left out of both matrices. The panel is already sorted by `date`
+    # and `permno`, so `unstack` walks contiguous blocks of the index.
+    market_cap = (
+        df_members.set_index(["date", "permno"])
+        .sort_index()["raw_market_cap"]
+        .unstack("permno")
+        .reindex(index=dates)
+        .fillna(0)
+    )
+    ever_member = panel[panel["permno"].isin(market_cap.columns)]
+    ret_matrix = (
+        ever_member.set_index(["date", "permno"])
+        .sort_index()["retx"]
+        .unstack("permno")
+        .reindex(index=dates, columns=market_cap.columns)
+    )
+    market_cap = np.ascontiguousarray(market_cap.to_numpy(dtype=np.float32))
+    # A missing return contributes nothing to the weighted sum, which is the
+    # same as a zero return.
+    ret_matrix = np.ascontiguousarray(
+        ret_matrix.to_numpy(dtype=np.float32, na_value=0.0)
+    )
 
-    # Shift weights up by one period (so t+1 returns multiply with t weights)
-    lagged_weights = portfolio_weights.shift(1)
+    # The portfolio takes on the index weights on rebalancing dates (the last
+    # date of each calendar quarter, and the first date) and holds them in
+    # between. For each date, find the rebalancing date whose weights are held
+    # going into that date.
+    is_rebalance = ~dates.to_period("Q").duplicated(keep="last")
+    is_rebalance[0] = True
+    last_rebalance = np.maximum.accumulate(
+        np.where(is_rebalance, np.arange(len(dates)), 0)
+    )
+    held_rebalance = np.concatenate([[0], last_rebalance[:-1]])
 
-    # Compute returns for each date using matrix multiplication
-    sp500_returns["ret_approx_B"] = (ret_matrix * lagged_weights).sum(
-        axis=1, skipna=True
+    sp500_returns = pd.DataFrame(index=dates)
+    sp500_returns["ret_approx_B"] = _rebalanced_portfolio_returns(
+        ret_matrix, market_cap, held_rebalance
     )
-    sp500_returns.iloc[0, 0] = np.nan
     sp500_returns = sp500_returns.reset_index()
 
     return sp500_returns
 
+
+@njit(cache=True, parallel=True, nogil=True)
+def _rebalanced_portfolio_returns(ret_matrix, market_cap, held_rebalance):
+    """
+    Kernel for `calculate_sp500_returns_with_rebalancing`.
+
+    `ret_matrix` and `market_cap` are (date x permno) float32 arrays, with the
+    market cap set to zero for stocks outside the index and missing returns
+    set to zero. On each date `t`, the portfolio holds the market cap weights
+    from row `held_rebalance[t]` and earns the returns in row `t`. The first
+    date has no return. Dates are independent of each other, so they are
+    computed in parallel, and each weighted sum is a single BLAS dot product.
+    """
+    n_dates = ret_matrix.shape[0]
+    out = np.full(n_dates, np.nan)
+    for t in prange(1, n_dates):
+        weights = market_cap[held_rebalance[t]]
+        total_cap = weights.sum()
+        if total_cap > 0:
+            out[t] = np.dot(weights, ret_matrix[t]) / total_cap
+        else:
+            out[t] = 0.0
+    return out
+
 def _demo_approximation_A():
     """
     Calculate the S&P 500 index using the approximation A. That is,
@@ -193,7 +332,9 @@ def _demo_approximation_A():
     of the normalized market cap series.
     """
     df_constituents = pull_SP500_constituents.load_constituents(data_dir=DATA_DIR)
-    df_msf = pull_CRSP_stock.load_CRSP_monthly_file(data_dir=DATA_DIR)
+    df_msf = pull_CRSP_stock.load_CRSP_monthly_file(
+        data_dir=DATA_DIR, columns=MSF_COLUMNS, dtype=MSF_DTYPES
+    )
     df_msix = pull_CRSP_stock.load_CRSP_index_files(data_dir=DATA_DIR)
 
     sp500_total_market_cap = calculate_sp500_total_market_cap(
@@ -225,8 +366,8 @@ def _demo_approximation_A():
         plt.show()
 
     # Print correlation
-    correlation = sp500_total_market_cap["sp500_market_cap_norm"].corr(
-        sp500_total_market_cap["spindx"]
+    correlation = misc_tools.fast_corr(
+        sp500_total_market_cap["sp500_market_cap_norm"], sp500_total_market_cap["spindx"]
     )
     print(f"Correlation between normalized market cap and index: {correlation:.4f}")
 
@@ -254,8 +395,8 @@ def _demo_approximation_A():
         plt.show()
 
     # Print correlation of returns
-    correlation = sp500_total_market_cap["ret_approx_A"].corr(
-        sp500_total_market_cap["sprtrn"]
+    correlation = misc_tools.fast_corr(
+        sp500_total_market_cap["ret_approx_A"], sp500_total_market_cap["sprtrn"]
     )
     print(f"Correlation between returns: {correlation:.4f}")
 
@@ -266,13 +407,14 @@ def _demo_approximation_B():
     rebalance the portfolio every quarter.
     """
     df_constituents = pull_SP500_constituents.load_constituents(data_dir=DATA_DIR)
-    df_msf = pull_CRSP_stock.load_CRSP_monthly_file(data_dir=DATA_DIR)
+    df_msf = pull_CRSP_stock.load_CRSP_monthly_file(
+        data_dir=DATA_DIR, columns=MSF_COLUMNS, dtype=MSF_DTYPES
+    )
     df_msix = pull_CRSP_stock.load_CRSP_index_files(data_dir=DATA_DIR)
 
     sp500_returns = calculate_sp500_returns_with_rebalancing(
         df_constituents, df_msf, start_date=START_DATE, end_date=END_DATE
     )
-    df_msix["date"] = pd.to_datetime(df_msix["caldt"])
     sp500_returns = pd.merge(
         df_msix[["date", "spindx", "sprtrn"]],
         sp500_returns,
@@ -285,12 +427,12 @@ def _demo_approximation_B():
     sp500_returns.describe()
 
     # Print correlation
-    correlation = sp500_returns["ret_approx_B"].corr(sp500_returns["sprtrn"])
+    correlation = misc_tools.fast_corr(sp500_returns["ret_approx_B"], sp500_returns["sprtrn"])
     print(f"Correlation between reconstructed and actual returns: {correlation:.4f}")
 
     # Calculate cumulative returns
-    sp500_returns["cumret_approx_B"] = (1 + sp500_returns["ret_approx_B"]).cumprod()
-    sp500_returns["cumret_actual"] = (1 + sp500_returns["sprtrn"]).cumprod()
+    sp500_returns["cumret_approx_B"] = misc_tools.cumulative_returns(sp500_returns["ret_approx_B"])
+    sp500_returns["cumret_actual"] = misc_tools.cumulative_returns(sp500_returns["sprtrn"])
 
     if True:
         # Plot cumulative returns
@@ -315,11 +457,13 @@ def _demo_approximation_B():
         plt.show()
 
     # Print correlation of returns
-    correlation = sp500_returns["ret_approx_B"].corr(sp500_returns["sprtrn"])
+    correlation = misc_tools.fast_corr(sp500_returns["ret_approx_B"], sp500_returns["sprtrn"])
     print(f"Correlation between returns: {correlation:.4f}")
 
     df_constituents = pull_SP500_constituents.load_constituents(data_dir=DATA_DIR)
-    df_msf = pull_CRSP_stock.load_CRSP_monthly_file(data_dir=DATA_DIR)
+    df_msf = pull_CRSP_stock.load_CRSP_monthly_file(
+        data_dir=DATA_DIR, columns=MSF_COLUMNS, dtype=MSF_DTYPES
+    )
     df_msix = pull_CRSP_stock.load_CRSP_index_files(data_dir=DATA_DIR)
 
     sp500_total_market_cap = calculate_sp500_total_market_cap(
@@ -349,24 +493,37 @@ def _demo_approximation_B():
 
 def create_sp500_index_approximations(data_dir=DATA_DIR):
     df_constituents = pull_SP500_constituents.load_constituents(data_dir=data_dir)
-    df_msf = pull_CRSP_stock.load_CRSP_monthly_file(data_dir=data_dir)
+    df_msf = pull_CRSP_stock.load_CRSP_monthly_file(
+        data_dir=data_dir, columns=MSF_COLUMNS, dtype=MSF_DTYPES
+    )
     df_msix = pull_CRSP_stock.load_CRSP_index_files(data_dir=data_dir)
-
-    ## Approximation A
-    sp500_total_market_cap = calculate_sp500_total_market_cap(
+    df_constituents, df_msf = categorize_permno(df_constituents, df_msf)
+    panel = build_member_panel(
         df_constituents, df_msf, start_date=START_DATE, end_date=END_DATE
     )
 
+    # Approximations A and B only read from the shared panel, so they run
+    # side by side. Threads avoid copying the panel into worker processes,
+    # and the heavy steps (pandas/NumPy and the Numba kernel) release the GIL.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_A = executor.submit(
+            calculate_sp500_total_market_cap, df_constituents, df_msf, panel=panel
+        )
+        future_B = executor.submit(
+            calculate_sp500_returns_with_rebalancing,
+            df_constituents,
+            df_msf,
+            panel=panel,
+        )
+        sp500_total_market_cap = future_A.result()
+        sp500_returns = future_B.result()
+
+    ## Approximation A
     sp500_total_market_cap = append_actual_sp500_index_and_approx_returns_A(
         sp500_total_market_cap,
         df_msix,
     )
 
-    ## Approximation B
-    sp500_returns = calculate_sp500_returns_with_rebalancing(
-        df_constituents, df_msf, start_date=START_DATE, end_date=END_DATE
-    )
-
     df = pd.merge(sp500_total_market_cap, sp500_returns, on="date", how="inner")
 
     # df.info()
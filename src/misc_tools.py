@@ -716,6 +716,54 @@ def leave_one_out_sums(df, groupby=[], summed_col=""):
     return s
 
 
+def cumulative_returns(ret):
+    """Compound a series of simple returns into cumulative returns.
+
+    Equivalent to `(1 + ret).cumprod()`, but computed in log space as
+    `exp(cumsum(log1p(ret)))` in a single pass over a contiguous float32 array.
+    As with `cumprod`, missing returns are skipped and remain missing.
+
+    Examples
+    --------
+    ```
+    >>> cumulative_returns(pd.Series([0.1, np.nan, -0.5]))
+    0    1.10
+    1     NaN
+    2    0.55
+    dtype: float32
+
+    ```
+    """
+    values = ret.to_numpy(dtype=np.float32)
+    is_missing = np.isnan(values)
+    cumret = np.exp(np.cumsum(np.log1p(np.where(is_missing, 0, values))))
+    cumret[is_missing] = np.nan
+    return pd.Series(cumret, index=ret.index, name=ret.name)
+
+
+def fast_corr(x, y):
+    """Pearson correlation of two equally long series in a single pass.
+
+    Computes the correlation from the float32 means of `x`, `y`, and `x * y`,
+    which avoids the index alignment and intermediate objects of `Series.corr`.
+    The two series are paired up by position, not by index. As in
+    `Series.corr`, pairs where either value is missing are dropped.
+
+    Examples
+    --------
+    ```
+    >>> round(fast_corr(pd.Series([1, 2, 3, np.nan]), pd.Series([1, 3, 2, 4])), 4)
+    0.5
+
+    ```
+    """
+    x = x.to_numpy(dtype=np.float32)
+    y = y.to_numpy(dtype=np.float32)
+    keep = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[keep], y[keep]
+    return float(((x * y).mean() - x.mean() * y.mean()) / (x.std() * y.std()))
+
+
 def get_most_recent_quarter_end(d):
     """
     Take a datetime and find the most recent quarter end date
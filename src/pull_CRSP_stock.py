@@ -169,6 +169,13 @@ def pull_CRSP_monthly_file(
     # Deal with delisting returns
     df = apply_delisting_returns(df)
 
+    # Market cap and returns are the columns streamed through the index
+    # calculations, so store them as float32 and keep the panel sorted by
+    # (permno, date) so that each stock's history is contiguous on disk.
+    df["market_cap"] = df["market_cap"].astype("float32")
+    df["retx"] = df["retx"].astype("float32")
+    df = df.sort_values(["permno", "date"], ignore_index=True)
+
     return df
 
 
@@ -241,15 +248,31 @@ def pull_CRSP_index_files(
     return df
 
 
-def load_CRSP_monthly_file(data_dir=DATA_DIR):
+def load_CRSP_monthly_file(data_dir=DATA_DIR, columns=None, dtype=None):
+    """
+    Load the monthly CRSP stock file saved by `pull_CRSP_monthly_file`.
+
+    Pass `columns` to read only a subset of the columns from disk, and
+    `dtype` (a mapping of column name to dtype) to downcast them on load.
+    """
     path = Path(data_dir) / "CRSP_MSF_INDEX_INPUTS.parquet"
-    df = pd.read_parquet(path)
+    df = pd.read_parquet(path, columns=columns, memory_map=True)
+    if dtype is not None:
+        df = df.astype(dtype)
     return df
 
 
 def load_CRSP_index_files(data_dir=DATA_DIR):
+    """
+    Load the monthly CRSP index file saved by `pull_CRSP_index_files`.
+
+    The `caldt` column is parsed once here and returned as `date`, so that
+    it can be merged directly with the other monthly DataFrames.
+    """
     path = Path(data_dir) / f"CRSP_MSIX.parquet"
     df = pd.read_parquet(path)
+    df = df.rename(columns={"caldt": "date"})
+    df["date"] = pd.to_datetime(df["date"])
     return df
 
 
@@ -261,7 +284,7 @@ def _demo():
 if __name__ == "__main__":
     df_msf = pull_CRSP_monthly_file(start_date=START_DATE, end_date=END_DATE)
     path = Path(DATA_DIR) / "CRSP_MSF_INDEX_INPUTS.parquet"
-    df_msf.to_parquet(path)
+    df_msf.to_parquet(path, engine="pyarrow", compression="zstd")
 
     df_msix = pull_CRSP_index_files(start_date=START_DATE, end_date=END_DATE)
     path = Path(DATA_DIR) / f"CRSP_MSIX.parquet"
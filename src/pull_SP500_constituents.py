@@ -1,3 +1,6 @@
+import time
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
 import wrds
@@ -12,12 +15,10 @@ def pull_constituents(wrds_username=WRDS_USERNAME):
     db = wrds.Connection(wrds_username=wrds_username)
 
     df_constituents = db.raw_sql("""
-        SELECT 
-            permno, 
-            start AS mbrstartdt, 
-            ending AS mbrenddt
-        FROM crsp.msp500list
+        SELECT *
+        FROM crsp_m_indexes.dsp500list_v2
     """)
+    db.close()
 
     # Convert string columns to datetime if they aren't already
     df_constituents["mbrstartdt"] = pd.to_datetime(df_constituents["mbrstartdt"])
@@ -26,8 +27,24 @@ def pull_constituents(wrds_username=WRDS_USERNAME):
     return df_constituents
 
 
-def load_constituents(data_dir=DATA_DIR):
-    return pd.read_parquet(data_dir / "df_sp500_constituents.parquet")
+def load_constituents(data_dir=DATA_DIR, max_age_days=None, wrds_username=WRDS_USERNAME):
+    """
+    Load the S&P 500 constituents saved by `pull_constituents`.
+
+    If `max_age_days` is given, the saved file is treated as a cache: when it is
+    missing or was written more than `max_age_days` days ago, the constituents
+    are pulled from WRDS again and saved before loading.
+    """
+    path = Path(data_dir) / "df_sp500_constituents.parquet"
+    if max_age_days is not None:
+        is_stale = (
+            not path.exists()
+            or time.time() - path.stat().st_mtime > max_age_days * 24 * 60 * 60
+        )
+        if is_stale:
+            df_constituents = pull_constituents(wrds_username=wrds_username)
+            df_constituents.to_parquet(path, compression="zstd")
+    return pd.read_parquet(path)
 
 
 def _demo():
@@ -41,9 +58,11 @@ def _demo():
 
     df_msix.describe()
     df_msix.info()
-    df_msix[["caldt", "sprtrn", "spindx"]].describe()
+    df_msix[["date", "sprtrn", "spindx"]].describe()
 
 
 if __name__ == "__main__":
     df_constituents = pull_constituents(wrds_username=WRDS_USERNAME)
-    df_constituents.to_parquet(DATA_DIR / "df_sp500_constituents.parquet")
+    df_constituents.to_parquet(
+        DATA_DIR / "df_sp500_constituents.parquet", compression="zstd"
+    )
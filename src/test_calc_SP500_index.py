@@ -117,6 +117,129 @@ def test_cumulative_returns():
     assert 0.35 < sp500_data["sp500_cumret"].max()/years < 0.4
 
 
+def test_constituents_on():
+    """
+    Consider three membership spells:
+      permno #1 is in the index from 2020-01-15 through 2020-03-31
+      permno #2 is in the index from 2020-02-29 through 2020-02-29
+      permno #3 is in the index from 2020-05-01 onward (after the last date)
+    Then, on the month-end dates below, the constituents should be:
+      2020-01-31: #1
+      2020-02-29: #1, #2
+      2020-03-31: #1
+    """
+    constituents = pd.DataFrame(
+        data={
+            "permno": [1, 2, 3],
+            "mbrstartdt": pd.to_datetime(["2020-01-15", "2020-02-29", "2020-05-01"]),
+            "mbrenddt": pd.to_datetime(["2020-03-31", "2020-02-29", "2020-12-31"]),
+        }
+    )
+    dates = pd.to_datetime(["2020-01-31", "2020-02-29", "2020-03-31"])
+
+    members = calc_SP500_index.constituents_on(constituents, dates)
+
+    expected_output = pd.DataFrame(
+        data={
+            "date": pd.to_datetime(
+                ["2020-01-31", "2020-02-29", "2020-02-29", "2020-03-31"]
+            ),
+            "permno": [1, 1, 2, 1],
+        }
+    )
+    pd.testing.assert_frame_equal(members[["date", "permno"]], expected_output)
+
+
+def test_build_member_panel():
+    """
+    With the same spells as in `test_constituents_on`, a stock file covering
+    all three stocks should be flagged with the same constituents. Building
+    the panel again from the same inputs should reuse the cached panel.
+    """
+    constituents = pd.DataFrame(
+        data={
+            "permno": [1, 2, 3],
+            "mbrstartdt": pd.to_datetime(["2020-01-15", "2020-02-29", "2020-05-01"]),
+            "mbrenddt": pd.to_datetime(["2020-03-31", "2020-02-29", "2020-12-31"]),
+        }
+    )
+    dates = pd.to_datetime(["2020-01-31", "2020-02-29", "2020-03-31"])
+    msf = pd.DataFrame(
+        data={
+            "permno": np.repeat([1, 2, 3], 3),
+            "date": dates.append(dates).append(dates),
+            "prc": 1.0,
+            "shrout": 100.0,
+            "retx": 0.0,
+            "market_cap": 100.0,
+        }
+    )
+
+    panel = calc_SP500_index.build_member_panel(
+        constituents, msf, start_date=dates[0], end_date=dates[-1]
+    )
+
+    members = panel.loc[panel["in_sp500"], ["date", "permno"]].reset_index(drop=True)
+    expected_output = pd.DataFrame(
+        data={
+            "date": pd.to_datetime(
+                ["2020-01-31", "2020-02-29", "2020-02-29", "2020-03-31"]
+            ),
+            "permno": [1, 1, 2, 1],
+        }
+    )
+    pd.testing.assert_frame_equal(members, expected_output)
+    assert (
+        calc_SP500_index.build_member_panel(
+            constituents, msf, start_date=dates[0], end_date=dates[-1]
+        )
+        is panel
+    )
+
+
+def test_returns_with_rebalancing():
+    """
+    Consider two stocks that are in the index over the whole sample, with
+    100 shares outstanding each and the prices below.
+
+    time=Jan (first date, so the portfolio is formed):
+      mktcaps are 100 and 300, so the weights are 0.25 and 0.75
+    time=Feb (not a rebalancing month, hold the Jan weights):
+      returns are 1.0 and 0, so the return is 0.25 * 1.0 = 0.25
+    time=Mar (rebalancing month, the Feb weights are still held):
+      returns are 0.5 and 0, so the return is 0.25 * 0.5 = 0.125
+      mktcaps are 300 and 300, so the new weights are 0.5 and 0.5
+    time=Apr:
+      returns are 0.1 and 0.2, so the return is 0.5 * 0.1 + 0.5 * 0.2 = 0.15
+    """
+    dates = pd.to_datetime(["2020-01-31", "2020-02-28", "2020-03-31", "2020-04-30"])
+    msf = pd.DataFrame(
+        data={
+            "permno": [1, 1, 1, 1, 2, 2, 2, 2],
+            "date": dates.append(dates),
+            "prc": [1, 2, 3, 3.3, 3, 3, 3, 3.6],
+            "shrout": [100, 100, 100, 100, 100, 100, 100, 100],
+            "retx": [0, 1.0, 0.5, 0.1, 0, 0, 0, 0.2],
+        }
+    )
+    constituents = pd.DataFrame(
+        data={
+            "permno": [1, 2],
+            "mbrstartdt": pd.to_datetime(["2019-01-01", "2019-01-01"]),
+            "mbrenddt": pd.to_datetime(["2020-12-31", "2020-12-31"]),
+        }
+    )
+
+    sp500_returns = calc_SP500_index.calculate_sp500_returns_with_rebalancing(
+        constituents, msf, start_date="2020-01-01", end_date="2020-12-31"
+    )
+
+    expected_output = pd.DataFrame(
+        data={"date": dates, "ret_approx_B": [np.nan, 0.25, 0.125, 0.15]}
+    )
+    pd.testing.assert_frame_equal(sp500_returns.round(4), expected_output.round(4))
+
+
 def test_constituent_columns():
     """Test that constituent DataFrame has required columns"""
     required_columns = {"permno", "indno", "mbrstartdt", "mbrenddt", "mbrflg", "indfam"}
@@ -155,7 +278,7 @@ def test_msf_columns():
 def test_msix_columns():
     """Test that index file DataFrame has required columns"""
     required_columns = {
-        "caldt",
+        "date",
         "vwretd",
         "vwindd",
         "vwretx",